@@ -40,16 +40,29 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 import os
-import time
+import errno
+import asyncio
 import sys
 import signal
 import getopt
-from struct import unpack
-import threading
+from struct import Struct
 import array
+import collections
+import contextlib
+import types
+import ctypes
 from fcntl import ioctl
 import serial
-from gpiozero import Button
+try:
+    # Only needed for buttons connected to GPIO pins
+    import lgpio
+except ImportError:
+    lgpio = None
+try:
+    # Optional faster event loop based on libuv
+    import uvloop
+except ImportError:
+    uvloop = None
 from nsgpadserial import NSGamepadSerial, NSButton, NSDPad
 
 # Map the 4 direction buttons (up, right, down, left) to NS direction pad values
@@ -74,6 +87,45 @@ BUTTONS_MAP_DPAD = array.array('B', [
     NSDPad.CENTERED     # 1111
 ])
 
+# Print each speech command and the controls it presses. Printing is slow
+# enough to delay the button presses so it is off by default.
+DEBUG = False
+
+# struct js_event from linux/joystick.h. The signed 16 bit value is read as
+# unsigned so it can index AXIS_LUT.
+JS_EVENT = Struct('IHBB')
+# Up to this many events are returned by one read() of a joystick
+JS_EVENTS_PER_READ = 32
+# Joystick ioctl requests from linux/joystick.h
+JSIOCGNAME_64 = 0x80006a13 + (0x10000 * 64) # JSIOCGNAME(64)
+JSIOCGAXES = 0x80016a11
+
+# Map joystick axis values -32768..0..32767 (read as unsigned) to NS axis
+# values 0..128..255
+AXIS_LUT = bytes(((value ^ 0x8000) >> 8) for value in range(65536))
+
+def write_sysfs(path, value):
+    """ Write value to a sysfs attribute. Return False if that fails, for example when not root. """
+    try:
+        with open(path, 'w') as attribute:
+            attribute.write(value)
+    except OSError:
+        return False
+    return True
+
+def realtime_priority():
+    """
+    Run the joystick event loop, and the lgpio thread started after this, at
+    a low real time priority so input is handled as soon as it arrives even
+    when other programs keep the CPUs busy. Return False if that fails, for
+    example when not root.
+    """
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(1))
+    except OSError:
+        return False
+    return True
+
 NSG = NSGamepadSerial()
 try:
     # Raspberry Pi UART on pins 14,15
@@ -84,55 +136,60 @@ except:
         # CP210x is capable of 2,000,000 bits/sec
         NS_SERIAL = serial.Serial('/dev/ttyUSB0', 2000000, timeout=0)
         print("Found ttyUSB0")
+        # FTDI adapters hold partly full USB packets for up to 16 ms by default
+        write_sysfs('/sys/bus/usb-serial/devices/ttyUSB0/latency_timer', '1')
     except:
         print("NSGadget serial port not found")
         sys.exit(1)
 NSG.begin(NS_SERIAL)
 
-def read_horipad(jsdev):
+def axis_ignore(axis):
+    """ Axis handler for axes that are not used """
+    return
+
+def throttle_axis(button, threshold):
     """
-    The Hori HoriPad is a Nintendo Switch compatible gamepad.
-    Buttons and axes are mapped straight through so this is
-    the easiest. Runs as a thread
+    Return an axis handler for an analog throttle. The NS throttle is a
+    button so press it when the axis is past threshold.
     """
-    while True:
-        try:
-            evbuf = jsdev.read(8)
-        except:
-            jsdev.close()
-            break
-        if evbuf:
-            timestamp, value, type, number = unpack('IhBB', evbuf)
-            if type == 0x01: # button event
-                if value:
-                    NSG.press(number)
-                else:
-                    NSG.release(number)
-
-            if type == 0x02: # axis event
-                axis = ((value + 32768) >> 8)
-                # Axes 0,1 left stick X,Y
-                if number == 0:
-                    NSG.leftXAxis(axis)
-                elif number == 1:
-                    NSG.leftYAxis(axis)
-                # Axes 2,3 right stick X,Y
-                elif number == 2:
-                    NSG.rightXAxis(axis)
-                elif number == 3:
-                    NSG.rightYAxis(axis)
-                # Axes 4,5 directional pad X,Y
-                elif number == 4:
-                    NSG.dPadXAxis(axis)
-                elif number == 5:
-                    NSG.dPadYAxis(axis)
-
-def read_hori_wheel(jsdev):
+    def axis_handler(axis):
+        if axis > threshold:
+            NSG.press(button)
+        else:
+            NSG.release(button)
+    return axis_handler
+
+class DeviceSchema(object):
     """
-    The Hori Hori Maro Wheel is a Nintendo Switch compatible racing wheel.
-    Runs as a thread.
+    How to map a joystick to the NS gamepad.
+    buttons: NS button for each joystick button number. 252..255 are the
+             direction pad left, down, right, up bits, the same as for GPIO
+             buttons.
+    axes: axis handler for each joystick axis number. The handler is called
+          with the axis value 0..128..255.
     """
-    BUTTON_MAP = array.array('B', [
+    __slots__ = ('buttons', 'axes')
+
+    def __init__(self, buttons, axes):
+        self.buttons = buttons
+        self.axes = axes
+
+# The Hori HoriPad is a Nintendo Switch compatible gamepad.
+# Buttons and axes are mapped straight through so this is
+# the easiest.
+HORIPAD_SCHEMA = DeviceSchema(
+    array.array('B', range(16)),
+    (
+        NSG.leftXAxis,      # Axes 0,1 left stick X,Y
+        NSG.leftYAxis,
+        NSG.rightXAxis,     # Axes 2,3 right stick X,Y
+        NSG.rightYAxis,
+        NSG.dPadXAxis,      # Axes 4,5 directional pad X,Y
+        NSG.dPadYAxis))
+
+# The Hori Hori Maro Wheel is a Nintendo Switch compatible racing wheel.
+HORI_WHEEL_SCHEMA = DeviceSchema(
+    array.array('B', [
         NSButton.A,
         NSButton.B,
         NSButton.X,
@@ -143,91 +200,46 @@ def read_hori_wheel(jsdev):
         NSButton.PLUS,
         NSButton.HOME,
         NSButton.LEFT_STICK,
-        NSButton.RIGHT_STICK])
+        NSButton.RIGHT_STICK]),
+    (
+        NSG.leftXAxis,      # Axes 0,1 left stick X,Y
+        NSG.leftYAxis,
+        throttle_axis(NSButton.LEFT_THROTTLE, 64),
+        NSG.rightXAxis,     # Axes 3,4 right stick X,Y
+        NSG.rightYAxis,
+        throttle_axis(NSButton.RIGHT_THROTTLE, 64),
+        NSG.dPadXAxis,      # Axes 6,7 directional pad X,Y
+        NSG.dPadYAxis))
 
-    last_left_throttle = 0
-    last_right_throttle = 0
-    last_wheel = 128
-    while True:
-        try:
-            evbuf = jsdev.read(8)
-        except:
-            jsdev.close()
-            break
-        if evbuf:
-            timestamp, value, type, number = unpack('IhBB', evbuf)
-            if type == 0x01: # button event
-                button_out = BUTTON_MAP[number]
-                if value:
-                    NSG.press(button_out)
-                else:
-                    NSG.release(button_out)
-
-            if type == 0x02: # axis event
-                axis = ((value + 32768) >> 8)
-                # Axes 0,1 left stick X,Y
-                if number == 0:
-                    if last_wheel != axis:
-                        NSG.leftXAxis(axis)
-                elif number == 1:
-                    NSG.leftYAxis(axis)
-                elif number == 2:
-                    if last_left_throttle != axis:
-                        last_left_throttle = axis
-                        if axis > 64:
-                            NSG.press(NSButton.LEFT_THROTTLE)
-                        else:
-                            NSG.release(NSButton.LEFT_THROTTLE)
-                # Axes 3,4 right stick X,Y
-                elif number == 3:
-                    NSG.rightXAxis(axis)
-                elif number == 4:
-                    NSG.rightYAxis(axis)
-                elif number == 5:
-                    if last_right_throttle != axis:
-                        last_right_throttle = axis
-                        if axis > 64:
-                            NSG.press(NSButton.RIGHT_THROTTLE)
-                        else:
-                            NSG.release(NSButton.RIGHT_THROTTLE)
-                # Axes 6,7 directional pad X,Y
-                elif number == 6:
-                    NSG.dPadXAxis(axis)
-                elif number == 7:
-                    NSG.dPadYAxis(axis)
-
-def read_xbox1(jsdev):
-    """
-    The Xbox One controller has fewer buttons and the throttles are analog instead of buttons.
-    Runs as a thread
-    axis    0: left stick X
-            1: left stick Y
-            2: left throttle
-            3: right stick X
-            4: right stick Y
-            5: right throttle
-            6: dPad X
-            7: dPad Y
-
-    button  0: A                NS B
-            1: B                NS A
-            2: X                NS Y
-            3: Y                NS X
-            4: left trigger     NS left trigger
-            5: right trigger    NS right trigger
-            6: windows          NS minus
-            7: lines            NS plus
-            8: logo             NS home
-            9: left stick button  NS left stick
-           10: right stick button NS right stick
-
-    windows lines
-
-        Y
-    X       B
-        A
-    """
-    BUTTON_MAP = array.array('B', [
+# The Xbox One controller has fewer buttons and the throttles are analog instead of buttons.
+# axis    0: left stick X
+#         1: left stick Y
+#         2: left throttle
+#         3: right stick X
+#         4: right stick Y
+#         5: right throttle
+#         6: dPad X
+#         7: dPad Y
+#
+# button  0: A                NS B
+#         1: B                NS A
+#         2: X                NS Y
+#         3: Y                NS X
+#         4: left trigger     NS left trigger
+#         5: right trigger    NS right trigger
+#         6: windows          NS minus
+#         7: lines            NS plus
+#         8: logo             NS home
+#         9: left stick button  NS left stick
+#        10: right stick button NS right stick
+#
+# windows lines
+#
+#     Y
+# X       B
+#     A
+XBOX1_SCHEMA = DeviceSchema(
+    array.array('B', [
         NSButton.B,
         NSButton.A,
         NSButton.Y,
@@ -238,90 +250,52 @@ def read_xbox1(jsdev):
         NSButton.PLUS,
         NSButton.HOME,
         NSButton.LEFT_STICK,
-        NSButton.RIGHT_STICK])
-
-    while True:
-        try:
-            evbuf = jsdev.read(8)
-        except:
-            jsdev.close()
-            break
-        if evbuf:
-            timestamp, value, type, number = unpack('IhBB', evbuf)
-            if type == 0x01: # button event
-                button_out = BUTTON_MAP[number]
-                if value:
-                    NSG.press(button_out)
-                else:
-                    NSG.release(button_out)
-
-            if type == 0x02: # axis event
-                axis = ((value + 32768) >> 8)
-                # Axes 0,1 left stick X,Y
-                if number == 0:
-                    NSG.leftXAxis(axis)
-                elif number == 1:
-                    NSG.leftYAxis(axis)
-                # Xbox throttle 0..255 but NS throttle is a button on/ff
-                elif number == 2:
-                    if axis > 128:
-                        NSG.press(NSButton.LEFT_THROTTLE)
-                    else:
-                        NSG.release(NSButton.LEFT_THROTTLE)
-                # Axes 3,4 right stick X,Y
-                elif number == 3:
-                    NSG.rightXAxis(axis)
-                elif number == 4:
-                    NSG.rightYAxis(axis)
-                # Xbox throttle 0..255 but NS throttle is a button on/ff
-                elif number == 5:
-                    if axis > 128:
-                        NSG.press(NSButton.RIGHT_THROTTLE)
-                    else:
-                        NSG.release(NSButton.RIGHT_THROTTLE)
-                # Axes 6,7 directional pad X,Y
-                elif number == 6:
-                    NSG.dPadXAxis(axis)
-                elif number == 7:
-                    NSG.dPadYAxis(axis)
-
-def read_ps4ds(jsdev):
-    """
-    The Sony Playstation 4 controller has fewer buttons. The throttles are
-    analog (see axes) and binary (see buttons). Runs as a thread.
-
-    axis    0: left stick X
-            1: left stick Y
-            2: left throttle
-            3: right stick X
-            4: right stick Y
-            5: right throttle
-            6: dPad X
-            7: dPad Y
-
-    button  0: cross            NS B
-            1: circle           NS A
-            2: triangle         NS X
-            3: square           NS Y
-            4: left trigger     NS left trigger
-            5: right trigger    NS right trigger
-            6: left throttle    NS left throttle
-            7: right throttle   NS right throttle
-            8: share            NS minus
-            9: options          NS plus
-           10: logo             NS home
-           11: left stick button  NS left stick button
-           12: right stick button NS rgith stick button
-
-
-    share   options
-
-            triangle
-    square          circle
-            cross
-    """
+        NSButton.RIGHT_STICK]),
+    # Xbox throttle 0..255 but NS throttle is a button on/off
+    (
+        NSG.leftXAxis,      # Axes 0,1 left stick X,Y
+        NSG.leftYAxis,
+        throttle_axis(NSButton.LEFT_THROTTLE, 128),
+        NSG.rightXAxis,     # Axes 3,4 right stick X,Y
+        NSG.rightYAxis,
+        throttle_axis(NSButton.RIGHT_THROTTLE, 128),
+        NSG.dPadXAxis,      # Axes 6,7 directional pad X,Y
+        NSG.dPadYAxis))
 
-    BUTTON_MAP = array.array('B', [
+# The Sony Playstation 4 controller has fewer buttons. The throttles are
+# analog (see axes) and binary (see buttons).
+#
+# axis    0: left stick X
+#         1: left stick Y
+#         2: left throttle
+#         3: right stick X
+#         4: right stick Y
+#         5: right throttle
+#         6: dPad X
+#         7: dPad Y
+#
+# button  0: cross            NS B
+#         1: circle           NS A
+#         2: triangle         NS X
+#         3: square           NS Y
+#         4: left trigger     NS left trigger
+#         5: right trigger    NS right trigger
+#         6: left throttle    NS left throttle
+#         7: right throttle   NS right throttle
+#         8: share            NS minus
+#         9: options          NS plus
+#        10: logo             NS home
+#        11: left stick button  NS left stick button
+#        12: right stick button NS rgith stick button
+#
+#
+# share   options
+#
+#         triangle
+# square          circle
+#         cross
+PS4DS_SCHEMA = DeviceSchema(
+    array.array('B', [
         NSButton.B,
         NSButton.A,
         NSButton.Y,
@@ -334,65 +308,41 @@ def read_ps4ds(jsdev):
         NSButton.PLUS,
         NSButton.HOME,
         NSButton.LEFT_STICK,
-        NSButton.RIGHT_STICK])
+        NSButton.RIGHT_STICK]),
+    # The throttle axes 2,5 are ignored because the throttle buttons 6,7
+    # are used instead.
+    (
+        NSG.leftXAxis,      # Axes 0,1 left stick X,Y
+        NSG.leftYAxis,
+        axis_ignore,
+        NSG.rightXAxis,     # Axes 3,4 right stick X,Y
+        NSG.rightYAxis,
+        axis_ignore,
+        NSG.dPadXAxis,      # Axes 6,7 directional pad X,Y
+        NSG.dPadYAxis))
 
-    while True:
-        try:
-            evbuf = jsdev.read(8)
-        except:
-            jsdev.close()
-            break
-        if evbuf:
-            timestamp, value, type, number = unpack('IhBB', evbuf)
-            if type == 0x01: # button event
-                button_out = BUTTON_MAP[number]
-                if value:
-                    NSG.press(button_out)
-                else:
-                    NSG.release(button_out)
-
-            if type == 0x02: # axis event
-                axis = ((value + 32768) >> 8)
-                # Axes 0,1 left stick X,Y
-                if number == 0:
-                    NSG.leftXAxis(axis)
-                elif number == 1:
-                    NSG.leftYAxis(axis)
-                # axis 2 Xbox throttle 0..255 but NS throttle is a button on/ff
-                # Axes 3,4 right stick X,Y
-                elif number == 3:
-                    NSG.rightXAxis(axis)
-                elif number == 4:
-                    NSG.rightYAxis(axis)
-                # axis 5 Xbox throttle 0..255 but NS throttle is a button on/ff
-                # Axes 6,7 directional pad X,Y
-                elif number == 6:
-                    NSG.dPadXAxis(axis)
-                elif number == 7:
-                    NSG.dPadYAxis(axis)
-
-def read_dragon_rise(jsdev, right_side):
-    """
-    Map two Dragon Rise arcade joysticks to one NS gamepad
-    The Dragon Rise arcade joystick has 1 stick and up to 10 buttons. Two are required
-    to make 1 gamepad with 2 sticks plus 18 buttons. The right_side flag determines
-    which joystick is the left or right side of the gamepad.
-    """
-    BUTTON_MAP_LEFT = array.array('B', [
+# Map two Dragon Rise arcade joysticks to one NS gamepad
+# The Dragon Rise arcade joystick has 1 stick and up to 10 buttons. Two are required
+# to make 1 gamepad with 2 sticks plus 18 buttons. One joystick is the left side
+# of the gamepad, the other is the right side.
+DRAGON_RISE_LEFT_SCHEMA = DeviceSchema(
+    array.array('B', [
         NSButton.LEFT_THROTTLE,
         NSButton.LEFT_TRIGGER,
         NSButton.MINUS,
         255,    # DPAD Up
-        255,    # DPAD Right
-        255,    # DPAD Down
-        255,    # DPAD Left
+        254,    # DPAD Right
+        253,    # DPAD Down
+        252,    # DPAD Left
         NSButton.LEFT_STICK,
         NSButton.CAPTURE,
         NSButton.CAPTURE,
         NSButton.CAPTURE,
-        NSButton.CAPTURE])
+        NSButton.CAPTURE]),
+    (NSG.leftXAxis, NSG.leftYAxis))     # Axes 0,1 left stick X,Y
 
-    BUTTON_MAP_RIGHT = array.array('B', [
+DRAGON_RISE_RIGHT_SCHEMA = DeviceSchema(
+    array.array('B', [
         NSButton.RIGHT_THROTTLE,
         NSButton.RIGHT_TRIGGER,
         NSButton.PLUS,
@@ -404,75 +354,32 @@ def read_dragon_rise(jsdev, right_side):
         NSButton.HOME,
         NSButton.HOME,
         NSButton.HOME,
-        NSButton.HOME])
+        NSButton.HOME]),
+    (NSG.rightXAxis, NSG.rightYAxis))   # Axes 0,1 right stick X,Y
 
-    dpad_bits = 0
-    while True:
-        try:
-            evbuf = jsdev.read(8)
-        except:
-            jsdev.close()
-            break
-        if evbuf:
-            timestamp, value, type, number = unpack('IhBB', evbuf)
-            if type == 0x01: # button event
-                if right_side:
-                    button_out = BUTTON_MAP_RIGHT[number]
-                else:
-                    button_out = BUTTON_MAP_LEFT[number]
-                if button_out == 255:
-                    if value:
-                        dpad_bits |= (1 << (number - 3))
-                    else:
-                        dpad_bits &= ~(1 << (number - 3))
-                    NSG.dPad(BUTTONS_MAP_DPAD[dpad_bits])
-                else:
-                    if value:
-                        NSG.press(button_out)
-                    else:
-                        NSG.release(button_out)
-
-            if type == 0x02: # axis event
-                # NS wants values 0..128..255 where 128 is center position
-                axis = ((value + 32768) >> 8)
-                if right_side:
-                    # Axes 0,1 right stick X,Y
-                    if number == 0:
-                        NSG.rightXAxis(axis)
-                    elif number == 1:
-                        NSG.rightYAxis(axis)
-                else:
-                    # Axes 0,1 left stick X,Y
-                    if number == 0:
-                        NSG.leftXAxis(axis)
-                    elif number == 1:
-                        NSG.leftYAxis(axis)
-
-def read_le3dp(jsdev):
-    """
-    The Logitech Extreme 3D Pro joystick (also known as a flight stick)
-    has a large X,Y,twist joystick with an 8-way hat switch on top.
-    This maps the large X,Y axes to the gamepad right thumbstick and
-    the hat switch to the gamepad left thumbstick. There are six
-    buttons on the top of the stick and six on the base. The twist
-    used to control the stick buttons. Each gamepad thumbstick is
-    also a button. For example, clicking the right thumbstick enables
-    stealth mode in Zelda:BOTW.
-    Map LE3DP button numbers to NS gamepad buttons
-    LE3DP buttons
-    0 = front trigger
-    1 = side thumb rest button
-    2 = top large left
-    3 = top large right
-    4 = top small left
-    5 = top small right
-
-    Button array (2 rows, 3 columns) on base
-
-    7 9 11
-    6 8 10
-    """
-    BUTTON_MAP = array.array('B', [
+# The Logitech Extreme 3D Pro joystick (also known as a flight stick)
+# has a large X,Y,twist joystick with an 8-way hat switch on top.
+# This maps the large X,Y axes to the gamepad right thumbstick and
+# the hat switch to the gamepad left thumbstick. There are six
+# buttons on the top of the stick and six on the base. The twist
+# used to control the stick buttons. Each gamepad thumbstick is
+# also a button. For example, clicking the right thumbstick enables
+# stealth mode in Zelda:BOTW.
+# Map LE3DP button numbers to NS gamepad buttons
+# LE3DP buttons
+# 0 = front trigger
+# 1 = side thumb rest button
+# 2 = top large left
+# 3 = top large right
+# 4 = top small left
+# 5 = top small right
+#
+# Button array (2 rows, 3 columns) on base
+#
+# 7 9 11
+# 6 8 10
+LE3DP_SCHEMA = DeviceSchema(
+    array.array('B', [
         NSButton.A,             # Front trigger
         NSButton.B,             # Side thumb trigger
         NSButton.X,             # top large left
@@ -484,71 +391,45 @@ def read_le3dp(jsdev):
         NSButton.CAPTURE,
         NSButton.HOME,
         NSButton.LEFT_THROTTLE,
-        NSButton.RIGHT_THROTTLE])
+        NSButton.RIGHT_THROTTLE]),
+    (
+        NSG.leftXAxis,      # Axes 0,1 -> NS left thumbstick X,Y
+        NSG.leftYAxis,
+        axis_ignore,        # Axis 2 twist
+        axis_ignore,        # Axis 3 throttle lever
+        NSG.rightXAxis,     # Axes 4,5 hat switch -> NS right thumbstick X,Y
+        NSG.rightYAxis))
 
-    while True:
-        try:
-            evbuf = jsdev.read(8)
-        except:
-            jsdev.close()
-            break
-        if evbuf:
-            timestamp, value, type, number = unpack('IhBB', evbuf)
-            if type == 0x01: # button event
-                button_out = BUTTON_MAP[number]
-                if value:
-                    NSG.press(button_out)
-                else:
-                    NSG.release(button_out)
-
-            if type == 0x02: # axis event
-                axis = ((value + 32768) >> 8)
-                # Axes 0,1 -> NS left thumbstick X,Y
-                if number == 0:
-                    NSG.leftXAxis(axis)
-                elif number == 1:
-                    NSG.leftYAxis(axis)
-                # Axis 2 twist
-                # Axis 3 throttle lever
-                # Axes 4,5 hat switch -> NS right thumbstick X,Y
-                elif number == 4:
-                    NSG.rightXAxis(axis)
-                elif number == 5:
-                    NSG.rightYAxis(axis)
-
-def read_t16k(jsdev):
-    """
-    Map T16K button numbers to NS gamepad buttons
-    The Thrustmaster T.16000M ambidextrous joystick (also known as a flight stick)
-    has a large X,Y,twist joystick with an 8-way hat switch on top.
-    This function maps the large X,Y axes to the gamepad right thumbstick and
-    the hat switch to the gamepad left thumbstick. There are four
-    buttons on the top of the stick and 12 on the base. The twist
-    used to control the stick buttons. Each gamepad thumbstick is
-    also a button. For example, clicking the right thumbstick enables
-    stealth mode in Zelda:BOTW.
-    Map T16K button numbers to NS gamepad buttons
-    T16K buttons
-    0 = trigger
-    1 = top center
-    2 = top left
-    3 = top right
-
-    Button array on base, left side
-
-    4
-    9 5
-      8 6
-        7
-
-    Button array on base, right side
-
-          10
-       11 15
-    12 14
-    13
-    """
-    BUTTON_MAP = array.array('B', [
+# Map T16K button numbers to NS gamepad buttons
+# The Thrustmaster T.16000M ambidextrous joystick (also known as a flight stick)
+# has a large X,Y,twist joystick with an 8-way hat switch on top.
+# This maps the large X,Y axes to the gamepad right thumbstick and
+# the hat switch to the gamepad left thumbstick. There are four
+# buttons on the top of the stick and 12 on the base. The twist
+# used to control the stick buttons. Each gamepad thumbstick is
+# also a button. For example, clicking the right thumbstick enables
+# stealth mode in Zelda:BOTW.
+# T16K buttons
+# 0 = trigger
+# 1 = top center
+# 2 = top left
+# 3 = top right
+#
+# Button array on base, left side
+#
+# 4
+# 9 5
+#   8 6
+#     7
+#
+# Button array on base, right side
+#
+#       10
+#    11 15
+# 12 14
+# 13
+T16K_SCHEMA = DeviceSchema(
+    array.array('B', [
         NSButton.A,             # Trigger
         NSButton.B,             # Top center
         NSButton.X,             # Top Left
@@ -564,83 +445,204 @@ def read_t16k(jsdev):
         NSButton.LEFT_THROTTLE, # Base right 12
         NSButton.RIGHT_THROTTLE,# Base right 13
         14,                     # Base right 14
-        15)                     # Base right 15
+        15]),                   # Base right 15
+    (
+        NSG.leftXAxis,      # Axes 0,1 -> NS left thumbstick X,Y
+        NSG.leftYAxis,
+        axis_ignore,        # Axis 2 twist
+        axis_ignore,        # Axis 3 throttle lever
+        NSG.rightXAxis,     # Axes 4,5 hat switch -> right thumbstick X,Y
+        NSG.rightYAxis))
+
+# Joysticks are recognized by a part of their upper case JSIOCGNAME name. The
+# first match wins. Dragon Rise arcade joysticks have no schema here because
+# they are used in pairs, see scan_joysticks.
+JOYSTICK_TYPES = (
+    (b'HORIPAD', "HoriPad", HORIPAD_SCHEMA),
+    (b'DRAGONRISE INC.', "Dragon Rise", None),
+    (b'LOGITECH EXTREME 3D', "Logitech Extreme 3D Pro", LE3DP_SCHEMA),
+    (b'THRUSTMASTER T.16000M', "Thrustmaster T.16000M", T16K_SCHEMA),
+    (b'MICROSOFT X-BOX ONE', "Xbox One", XBOX1_SCHEMA),
+    (b'SONY INTERACTIVE ENTERTAINMENT WIRELESS CONTROLLER', "Sony PS4DS", PS4DS_SCHEMA),
+    (b'GENERIC X-BOX PAD', "Hori Mario Wheel", HORI_WHEEL_SCHEMA))
 
+# Left and right halves of a gamepad made from 2 Dragon Rise joysticks
+DRAGON_RISE_SCHEMAS = (DRAGON_RISE_LEFT_SCHEMA, DRAGON_RISE_RIGHT_SCHEMA)
+
+def joystick_type(jslongname):
+    """ Return (label, schema) for an upper case joystick name or None if it is not supported """
+    for needle, label, schema in JOYSTICK_TYPES:
+        if needle in jslongname:
+            return label, schema
+    return None
+
+def read_joystick(schema, num_axes):
+    """
+    Map joystick button and axis events to the NS gamepad as described by
+    schema. num_axes is the number of axes the joystick has. Runs as an event
+    consumer, see joystick_ready().
+    """
+    BUTTON_MAP = schema.buttons
+    # Pad the axis table so every axis number from the joystick indexes it
+    AXIS_MAP = schema.axes + (axis_ignore,) * (num_axes - len(schema.axes))
+    # Local names are faster than looking up NSG methods for every event
+    press = NSG.press
+    release = NSG.release
+    dpad = NSG.dPad
+    dpad_bits = 0
+    pending = {}
+    # Last value sent for each axis, -1 until the first update
+    last_axis = [-1] * len(AXIS_MAP)
     while True:
+        evbuf = yield
+        # Button, direction pad and axis changes from one read go out in one report
+        with NSG.batch():
+            for timestamp, value, type, number in JS_EVENT.iter_unpack(evbuf):
+                if type == 0x02: # axis event
+                    # NS wants values 0..128..255 where 128 is center position
+                    pending[number] = AXIS_LUT[value]
+                elif type == 0x01 and number < len(BUTTON_MAP): # button event
+                    button_out = BUTTON_MAP[number]
+                    if button_out >= 252:
+                        # Set the button's direction pad bit if pressed, clear it if released
+                        mask = 1 << (255 - button_out)
+                        dpad_bits = (dpad_bits & ~mask) | (-bool(value) & mask)
+                        dpad(BUTTONS_MAP_DPAD[dpad_bits])
+                    elif value:
+                        press(button_out)
+                    else:
+                        release(button_out)
+            # Send each axis at most once per read and only if it changed
+            for number, axis in pending.items():
+                if last_axis[number] == axis:
+                    continue
+                last_axis[number] = axis
+                AXIS_MAP[number](axis)
+            pending.clear()
+
+class LoopBatch(object):
+    """
+    Hold NSG.batch() open from the first joystick read in an event loop
+    iteration until all callbacks that were ready in that iteration have run,
+    so joysticks that have events at the same time, such as both Dragon Rise
+    halves of a gamepad, send one report between them.
+    """
+    def __init__(self):
+        self.stack = contextlib.ExitStack()
+        self.holding = False
+
+    def hold(self, loop):
+        """ Start the batch unless it is already held for this iteration """
+        if not self.holding:
+            self.holding = True
+            self.stack.enter_context(NSG.batch())
+            # Callbacks scheduled now run after the ones already ready
+            loop.call_soon(self.release)
+
+    def release(self):
+        """ End the batch and send the report """
+        self.holding = False
+        self.stack.close()
+
+LOOP_BATCH = LoopBatch()
+
+def joystick_ready(loop, jsname, jsdev, evbuf, parser, removed):
+    """
+    Called by the event loop when jsdev has events to read. The events are
+    read into the joystick's own buffer evbuf then sent to parser, a
+    read_joystick() generator. When the joystick is unplugged the read fails so
+    stop watching it, close it and call removed(jsname).
+    """
+    LOOP_BATCH.hold(loop)
+    # A full buffer means more events may be waiting so keep reading until a
+    # short read instead of going back through epoll for each buffer.
+    count = len(evbuf)
+    while count == len(evbuf):
         try:
-            evbuf = jsdev.read(8)
-        except:
+            count = jsdev.readinto(evbuf)
+        except OSError as err:
+            # ENODEV or EIO means the joystick was unplugged
+            if err.errno not in (errno.ENODEV, errno.EIO):
+                print("joystick read failed:", err)
+            count = 0
+        if count is None:
+            # The joystick is non-blocking and has nothing more to read
+            return
+        if not count:
+            loop.remove_reader(jsdev)
             jsdev.close()
-            break
-        if evbuf:
-            timestamp, value, type, number = unpack('IhBB', evbuf)
-            if type == 0x01: # button event
-                button_out = BUTTON_MAP[number]
-                if value:
-                    NSG.press(button_out)
-                else:
-                    NSG.release(button_out)
-
-            if type == 0x02: # axis event
-                # NS wants values 0..128..255 where 128 is center position
-                axis = ((value + 32768) >> 8)
-                # Axes 0,1 -> NS left thumbstick X,Y
-                if number == 0:
-                    NSG.leftXAxis(axis)
-                elif number == 1:
-                    NSG.leftYAxis(axis)
-                # Axis 2 twist
-                # Axis 3 throttle lever
-                # Axes 4,5 hat switch -> right thumbstick X,Y
-                elif number == 4:
-                    NSG.rightXAxis(axis)
-                elif number == 5:
-                    NSG.rightYAxis(axis)
+            removed(jsname)
+            return
+        parser.send(evbuf[:count])
+
+def start_reader(loop, jsname, jsdev, parser, removed):
+    """
+    Start parser and have the event loop feed it events from jsdev. removed is
+    called with jsname when the joystick is unplugged.
+    """
+    evbuf = memoryview(bytearray(JS_EVENT.size * JS_EVENTS_PER_READ))
+    os.set_blocking(jsdev.fileno(), False)
+    next(parser)
+    loop.add_reader(jsdev, joystick_ready, loop, jsname, jsdev, evbuf, parser, removed)
 
 class DpadBits(object):
     """ Convert 4 direction buttons to direction pad values """
     def __init__(self):
         self.dpad_bits = 0
 
-    def set_bit(self, bit_num):
-        """ Set bit in direction pad bit map. Update NSGadget direction pad. """
-        self.dpad_bits |= (1 << bit_num)
-        return BUTTONS_MAP_DPAD[self.dpad_bits]
-
-    def clear_bit(self, bit_num):
-        """ Clear bit in direction pad bit map. Update NSGadget direction pad. """
-        self.dpad_bits &= ~(1 << bit_num)
+    def update(self, bit_num, pressed):
+        """
+        Set bit in direction pad bit map if pressed, else clear it. Return the
+        new NSGadget direction pad value.
+        """
+        mask = 1 << bit_num
+        self.dpad_bits = (self.dpad_bits & ~mask) | (-bool(pressed) & mask)
         return BUTTONS_MAP_DPAD[self.dpad_bits]
 
 def gpio_handler():
-    """ Thread to handle buttons connected to GPIO pins. """
-    all_buttons = {}
+    """
+    Handle buttons connected to GPIO pins. All pins are watched through one
+    gpiochip file descriptor and lgpio calls gpio_edge() for every edge so
+    no thread per pin is needed.
+    """
+    # NS button for each BCM GPIO number, -1 if no button is connected.
+    # 0..127 are NS buttons, 252..255 are direction pad bits.
+    all_buttons = array.array('h', [-1] * 54)
     dpad_bits = DpadBits()
 
-    def gpio_pressed(button):
+    def gpio_pressed(pin):
         """ Called when button connected to GPIO pin is pressed/closed """
-        print('pressed', button.pin)
-        if button.pin in all_buttons:
-            ns_button = all_buttons[button.pin]
+        print('pressed', pin)
+        ns_button = all_buttons[pin]
+        if ns_button >= 0:
             if ns_button < 128:
                 NSG.press(ns_button)
             else:
-                NSG.dPad(dpad_bits.set_bit(255 - ns_button))
+                NSG.dPad(dpad_bits.update(255 - ns_button, True))
         else:
             print('Invalid button');
 
-    def gpio_released(button):
+    def gpio_released(pin):
         """ Called when button connected to GPIO pin is released/opened """
-        print('released', button.pin)
-        if button.pin in all_buttons:
-            ns_button = all_buttons[button.pin]
+        print('released', pin)
+        ns_button = all_buttons[pin]
+        if ns_button >= 0:
             if ns_button < 128:
                 NSG.release(ns_button)
             else:
-                NSG.dPad(dpad_bits.clear_bit(255 - ns_button))
+                NSG.dPad(dpad_bits.update(255 - ns_button, False))
         else:
             print('Invalid button');
 
+    def gpio_edge(chip, pin, level, tick):
+        """ Called by lgpio when a GPIO pin changes level """
+        # The buttons connect the pin to ground so low means pressed. Level 2
+        # is a watchdog timeout, not an edge.
+        if level == 0:
+            gpio_pressed(pin)
+        elif level == 1:
+            gpio_released(pin)
+
     gpio_ns_map = (
         # Left side (blue joy-con) buttons
         {'gpio_number': 4, 'ns_button': NSButton.LEFT_THROTTLE},
@@ -664,200 +666,389 @@ def gpio_handler():
         {'gpio_number': 20, 'ns_button': NSButton.Y},
         {'gpio_number': 21, 'ns_button': NSButton.RIGHT_STICK}
     )
-    # For each GPIO to NS button entry, allocate gpiozero Button object
-    # and update all_buttons dictionary. The when_pressed and when_released
-    # callback functions use all_buttons to find the corresponding
+    if lgpio is None:
+        print('GPIO not available: lgpio is not installed')
+        return
+    try:
+        chip = lgpio.gpiochip_open(0)
+    except lgpio.error as err:
+        print('GPIO not available:', err)
+        return
+    # For each GPIO to NS button entry, claim the pin for edge alerts with
+    # the pull up enabled and update all_buttons array. The gpio_edge
+    # callback function uses all_buttons to find the corresponding
     # NS button value.
     for element in gpio_ns_map:
-        element['button'] = Button(element['gpio_number'])
-        all_buttons[element['button'].pin] = element['ns_button']
-        element['button'].when_pressed = gpio_pressed
-        element['button'].when_released = gpio_released
-
-    signal.pause()
-
-def read_speech():
-    """ Read text from speech to text engine (Deep Speech) """
-    COMMAND_DICT = {
-            'left and right': {'buttons': [NSButton.LEFT_TRIGGER, NSButton.RIGHT_TRIGGER]},
-            'left trigger': {'buttons': [NSButton.LEFT_TRIGGER]},
-            'left button': {'buttons': [NSButton.LEFT_TRIGGER]},
-            'right trigger': {'buttons': [NSButton.RIGHT_TRIGGER]},
-            'right button': {'buttons': [NSButton.RIGHT_TRIGGER]},
-            'left throttle': {'buttons': [NSButton.LEFT_THROTTLE]},
-            'right throttle': {'buttons': [NSButton.RIGHT_THROTTLE]},
-            'plus': {'buttons': [NSButton.PLUS]},
-            'options': {'buttons': [NSButton.PLUS]},
-            'minus': {'buttons': [NSButton.MINUS]},
-            'capture': {'buttons': [NSButton.CAPTURE]},
-            'go home': {'buttons': [NSButton.HOME]},
-            'home': {'buttons': [NSButton.HOME]},
-            'okay': {'buttons': [NSButton.A]},
-            'continue': {'buttons': [NSButton.A]},
-            'confirm': {'buttons': [NSButton.A]},
-            'start': {'buttons': [NSButton.A]},
-            'back': {'buttons': [NSButton.B]},
-            'go back': {'buttons': [NSButton.B]},
-            'baker': {'buttons': [NSButton.B]},
-            'cancel': {'buttons': [NSButton.X]},
-            'close': {'buttons': [NSButton.X]},
-            'direction up': {'dpad': NSDPad.UP},
-            'direction down': {'dpad': NSDPad.DOWN},
-            'direction left': {'dpad': NSDPad.LEFT},
-            'direction right': {'dpad': NSDPad.RIGHT},
-            'move up': {'dpad': NSDPad.UP},
-            'move down': {'dpad': NSDPad.DOWN},
-            'move left': {'dpad': NSDPad.LEFT},
-            'move right': {'dpad': NSDPad.RIGHT},
-            # Pinball commands
-            'launch ball': {'buttons': [NSButton.A]},
-            # Zelda BOTW commands
-            'jump': {'buttons': [NSButton.X]},
-            'climb': {'buttons': [NSButton.X]},
-            'attack': {'buttons': [NSButton.Y]},
-            'fight': {'buttons': [NSButton.Y]},
-            'take': {'buttons': [NSButton.A]},
-            'crouch': {'buttons': [NSButton.LEFT_STICK]},
-            'crunch': {'buttons': [NSButton.LEFT_STICK]},
-            'zoom': {'buttons': [NSButton.RIGHT_STICK]},
-            'long distance': {'buttons': [NSButton.RIGHT_STICK]},
-            'look far': {'buttons': [NSButton.RIGHT_STICK]},
-            'use rune': {'buttons': [NSButton.LEFT_TRIGGER]},
-            'use spell': {'buttons': [NSButton.LEFT_TRIGGER]},
-            'use magic': {'buttons': [NSButton.LEFT_TRIGGER]},
-            'throw': {'buttons': [NSButton.RIGHT_TRIGGER]},
-            'switch shield': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.LEFT},
-            'switch weapon': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.RIGHT},
-            'switch magic': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.UP},
-            'which shield': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.LEFT},
-            'which weapon': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.RIGHT},
-            'which magic': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.UP},
-            'change shield': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.LEFT},
-            'change weapon': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.RIGHT},
-            'change magic': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.UP},
-            'throw': {'buttons': [NSButton.RIGHT_TRIGGER]},
-            'center camera': {'buttons': [NSButton.LEFT_THROTTLE]},
-            'enter camera': {'buttons': [NSButton.LEFT_THROTTLE]},
-            'centre camera': {'buttons': [NSButton.LEFT_THROTTLE]},
-            'camera': {'buttons': [NSButton.LEFT_THROTTLE]},
-            'lock on': {'buttons': [NSButton.LEFT_THROTTLE]},
-            'raise shield': {'buttons': [NSButton.LEFT_THROTTLE]},
-            'parry': {'buttons': [NSButton.LEFT_THROTTLE, NSButton.A]},
-            'perry': {'buttons': [NSButton.LEFT_THROTTLE, NSButton.A]},
-            'block': {'buttons': [NSButton.LEFT_THROTTLE, NSButton.A]},
-            'back flip': {'buttons': [NSButton.LEFT_THROTTLE, NSButton.X, NSButton.LEFT_TRIGGER]},
-            'shield surf': {'buttons': [NSButton.LEFT_THROTTLE, NSButton.X, NSButton.A]},
-            'use bow': {'buttons': [NSButton.RIGHT_THROTTLE]},
-            'whistle': {'dpad': NSDPad.DOWN},
-            'call horse': {'dpad': NSDPad.DOWN},
-            'called horse': {'dpad': NSDPad.DOWN},
-            'all horse': {'dpad': NSDPad.DOWN},
-            'horse': {'dpad': NSDPad.DOWN},
-            'a horse': {'dpad': NSDPad.DOWN},
-            'get horse': {'dpad': NSDPad.DOWN},
-            'get a horse': {'dpad': NSDPad.DOWN},
-            'open slate': {'buttons': [NSButton.MINUS]},
-            'pause': {'buttons': [NSButton.PLUS]}
-    }
-    for line in sys.stdin:
-        command = line.rstrip()
-        print(command)
-        if command in COMMAND_DICT:
-            controls = COMMAND_DICT[command]
+        try:
+            lgpio.gpio_claim_alert(chip, element['gpio_number'], lgpio.BOTH_EDGES,
+                    lgpio.SET_PULL_UP)
+        except lgpio.error as err:
+            print('GPIO', element['gpio_number'], 'not available:', err)
+            continue
+        all_buttons[element['gpio_number']] = element['ns_button']
+        lgpio.callback(chip, element['gpio_number'], lgpio.BOTH_EDGES, gpio_edge)
+
+# Speech commands and the buttons and direction pad they press. Keys are
+# case folded so matching ignores case. Built once and read only.
+_COMMAND_DICT = {
+    'left and right': {'buttons': [NSButton.LEFT_TRIGGER, NSButton.RIGHT_TRIGGER]},
+    'left trigger': {'buttons': [NSButton.LEFT_TRIGGER]},
+    'left button': {'buttons': [NSButton.LEFT_TRIGGER]},
+    'right trigger': {'buttons': [NSButton.RIGHT_TRIGGER]},
+    'right button': {'buttons': [NSButton.RIGHT_TRIGGER]},
+    'left throttle': {'buttons': [NSButton.LEFT_THROTTLE]},
+    'right throttle': {'buttons': [NSButton.RIGHT_THROTTLE]},
+    'plus': {'buttons': [NSButton.PLUS]},
+    'options': {'buttons': [NSButton.PLUS]},
+    'minus': {'buttons': [NSButton.MINUS]},
+    'capture': {'buttons': [NSButton.CAPTURE]},
+    'go home': {'buttons': [NSButton.HOME]},
+    'home': {'buttons': [NSButton.HOME]},
+    'okay': {'buttons': [NSButton.A]},
+    'continue': {'buttons': [NSButton.A]},
+    'confirm': {'buttons': [NSButton.A]},
+    'start': {'buttons': [NSButton.A]},
+    'back': {'buttons': [NSButton.B]},
+    'go back': {'buttons': [NSButton.B]},
+    'baker': {'buttons': [NSButton.B]},
+    'cancel': {'buttons': [NSButton.X]},
+    'close': {'buttons': [NSButton.X]},
+    'direction up': {'dpad': NSDPad.UP},
+    'direction down': {'dpad': NSDPad.DOWN},
+    'direction left': {'dpad': NSDPad.LEFT},
+    'direction right': {'dpad': NSDPad.RIGHT},
+    'move up': {'dpad': NSDPad.UP},
+    'move down': {'dpad': NSDPad.DOWN},
+    'move left': {'dpad': NSDPad.LEFT},
+    'move right': {'dpad': NSDPad.RIGHT},
+    # Pinball commands
+    'launch ball': {'buttons': [NSButton.A]},
+    # Zelda BOTW commands
+    'jump': {'buttons': [NSButton.X]},
+    'climb': {'buttons': [NSButton.X]},
+    'attack': {'buttons': [NSButton.Y]},
+    'fight': {'buttons': [NSButton.Y]},
+    'take': {'buttons': [NSButton.A]},
+    'crouch': {'buttons': [NSButton.LEFT_STICK]},
+    'crunch': {'buttons': [NSButton.LEFT_STICK]},
+    'zoom': {'buttons': [NSButton.RIGHT_STICK]},
+    'long distance': {'buttons': [NSButton.RIGHT_STICK]},
+    'look far': {'buttons': [NSButton.RIGHT_STICK]},
+    'use rune': {'buttons': [NSButton.LEFT_TRIGGER]},
+    'use spell': {'buttons': [NSButton.LEFT_TRIGGER]},
+    'use magic': {'buttons': [NSButton.LEFT_TRIGGER]},
+    'throw': {'buttons': [NSButton.RIGHT_TRIGGER]},
+    'switch shield': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.LEFT},
+    'switch weapon': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.RIGHT},
+    'switch magic': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.UP},
+    'which shield': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.LEFT},
+    'which weapon': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.RIGHT},
+    'which magic': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.UP},
+    'change shield': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.LEFT},
+    'change weapon': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.RIGHT},
+    'change magic': {'buttons': [NSButton.RIGHT_TRIGGER], 'dpad': NSDPad.UP},
+    'throw': {'buttons': [NSButton.RIGHT_TRIGGER]},
+    'center camera': {'buttons': [NSButton.LEFT_THROTTLE]},
+    'enter camera': {'buttons': [NSButton.LEFT_THROTTLE]},
+    'centre camera': {'buttons': [NSButton.LEFT_THROTTLE]},
+    'camera': {'buttons': [NSButton.LEFT_THROTTLE]},
+    'lock on': {'buttons': [NSButton.LEFT_THROTTLE]},
+    'raise shield': {'buttons': [NSButton.LEFT_THROTTLE]},
+    'parry': {'buttons': [NSButton.LEFT_THROTTLE, NSButton.A]},
+    'perry': {'buttons': [NSButton.LEFT_THROTTLE, NSButton.A]},
+    'block': {'buttons': [NSButton.LEFT_THROTTLE, NSButton.A]},
+    'back flip': {'buttons': [NSButton.LEFT_THROTTLE, NSButton.X, NSButton.LEFT_TRIGGER]},
+    'shield surf': {'buttons': [NSButton.LEFT_THROTTLE, NSButton.X, NSButton.A]},
+    'use bow': {'buttons': [NSButton.RIGHT_THROTTLE]},
+    'whistle': {'dpad': NSDPad.DOWN},
+    'call horse': {'dpad': NSDPad.DOWN},
+    'called horse': {'dpad': NSDPad.DOWN},
+    'all horse': {'dpad': NSDPad.DOWN},
+    'horse': {'dpad': NSDPad.DOWN},
+    'a horse': {'dpad': NSDPad.DOWN},
+    'get horse': {'dpad': NSDPad.DOWN},
+    'get a horse': {'dpad': NSDPad.DOWN},
+    'open slate': {'buttons': [NSButton.MINUS]},
+    'pause': {'buttons': [NSButton.PLUS]}
+}
+COMMAND_DICT = types.MappingProxyType(
+    {command.casefold(): controls for command, controls in _COMMAND_DICT.items()})
+
+class SpeechInput(object):
+    """
+    Read text from speech to text engine (Deep Speech) on speech_in, usually
+    standard input. The event loop calls ready() when text arrives. Each
+    command holds its buttons and direction pad for 75 ms, one command at a
+    time.
+    """
+    def __init__(self, loop, speech_in):
+        self.loop = loop
+        self.speech_in = speech_in
+        self.partial = b''
+        self.commands = collections.deque()
+        self.controls = None
+        try:
+            loop.add_reader(speech_in, self.ready)
+        except PermissionError:
+            # Regular files and /dev/null cannot be watched but never block
+            while self.ready():
+                pass
+
+    def ready(self):
+        """ Queue the commands read from speech_in. Return False at end of file. """
+        text = os.read(self.speech_in, 4096)
+        if text:
+            lines = (self.partial + text).split(b'\n')
+            self.partial = lines.pop()
+        else:
+            self.loop.remove_reader(self.speech_in)
+            lines = [self.partial]
+            self.partial = b''
+        for line in lines:
+            command = line.strip().decode('utf-8', 'replace').casefold()
+            if DEBUG:
+                print(command)
+            controls = COMMAND_DICT.get(command)
+            if controls is not None:
+                self.commands.append(controls)
+        if self.controls is None:
+            self.press_next()
+        return bool(text)
+
+    def press_next(self):
+        """ Press the buttons of the next queued command """
+        if not self.commands:
+            self.controls = None
+            return
+        controls = self.controls = self.commands.popleft()
+        if DEBUG:
             print(controls)
+        # Press all buttons and the direction pad in one report
+        with NSG.batch():
             if 'buttons' in controls:
                 for btn in controls['buttons']:
-                    print('press ', btn)
+                    if DEBUG:
+                        print('press ', btn)
                     NSG.press(btn)
             if 'dpad' in controls:
-                print('dpad ', controls['dpad'])
+                if DEBUG:
+                    print('dpad ', controls['dpad'])
                 NSG.dPad(controls['dpad'])
-            time.sleep(0.075)
+        self.loop.call_later(0.075, self.release)
+
+    def release(self):
+        """ Release the buttons of the current command then press the next one """
+        controls = self.controls
+        with NSG.batch():
             if 'dpad' in controls:
-                print('dpad centered')
+                if DEBUG:
+                    print('dpad centered')
                 NSG.dPad(NSDPad.CENTERED)
             if 'buttons' in controls:
                 for btn in reversed(controls['buttons']):
-                    print('release ', btn)
+                    if DEBUG:
+                        print('release ', btn)
                     NSG.release(btn)
+        self.press_next()
+
+# inotify(7) events, called directly through libc so no extra module is needed
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+# struct inotify_event without the name that follows it
+INOTIFY_EVENT = Struct('iIII')
+
+def inotify_watch(path, mask):
+    """
+    Return a non-blocking inotify file descriptor watching path for mask
+    events. Return None if inotify is not available.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        inotify_fd = libc.inotify_init1(os.O_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+    if inotify_fd < 0:
+        return None
+    if libc.inotify_add_watch(inotify_fd, os.fsencode(path), mask) < 0:
+        os.close(inotify_fd)
+        return None
+    return inotify_fd
+
+def inotify_events(inotify_fd, buf):
+    """
+    Read the waiting events from inotify_fd into buf, a bytearray that is
+    reused for every read. Return a list of (mask, name).
+    """
+    events = []
+    try:
+        count = os.readv(inotify_fd, [buf])
+    except BlockingIOError:
+        return events
+    offset = 0
+    while offset < count:
+        wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+        offset += INOTIFY_EVENT.size
+        events.append((mask, buf[offset:offset + length].rstrip(b'\x00').decode()))
+        offset += length
+    return events
 
 def main():
     """ joystick ioctl code based on https://gist.github.com/rdb/8864666 """
-    threading.Thread(target=gpio_handler, args=(), daemon=True).start()
-    # Start thread that reads text from standard input.
-    threading.Thread(target=read_speech, args=(), daemon=True).start()
+    realtime_priority()
+    # Have usbhid poll USB gamepads and joysticks every 1 ms instead of the
+    # 4 to 10 ms most of them ask for. usbhid only reads this when a device is
+    # plugged in, see README.md for devices plugged in at power up.
+    write_sysfs('/sys/module/usbhid/parameters/jspoll', '1')
+    gpio_handler()
 
-    dr_count = 0
+    # One event loop reads from all joysticks and standard input and writes to
+    # the NS gadget device.
+    if uvloop is None:
+        loop = asyncio.new_event_loop()
+    else:
+        loop = uvloop.new_event_loop()
+    SpeechInput(loop, sys.stdin.fileno())
+    # Bit n is set while Dragon Rise joystick n is plugged in. Even numbers are
+    # left halves and odd numbers are right halves of a gamepad.
+    dr_in_use = 0
+    dr_numbers = {}
     joysticks = {}
-    joysticks_to_del = list()
-    while True:
-        # For all known joysticks make sure its thread is still alive. If not, forget the joystick
-        # The thread ends when the joystick is unplugged.
-        for jsname in joysticks:
-            if not joysticks[jsname].is_alive():
-                print("joystick %s removed" % jsname)
-                joysticks_to_del.append(jsname)
-        for jsname in joysticks_to_del:
-            del joysticks[jsname]
-        joysticks_to_del.clear()
-        # For all joysticks in /dev/input/ and not do not have a thread, start a thread
-        # Each thread reads from its associated joystick and writes to the NS gadget device.
-        for fn in os.listdir('/dev/input'):
+    # (inode number, joystick_type()) of each probed device, by device file
+    # name. The name is not read again unless the device file is replaced and
+    # devices that are not supported joysticks are not opened again. The inode
+    # number, not the device number, tells whether it was replaced because the
+    # next joystick plugged in gets the same jsN and device number.
+    probed = {}
+    # Reused by every joystick probe
+    name_buf = bytearray(64)
+    axes_buf = bytearray(1)
+
+    def joystick_removed(jsname):
+        """ Forget a joystick when it is unplugged """
+        nonlocal dr_in_use
+        print("joystick %s removed" % jsname)
+        del joysticks[jsname]
+        if jsname in dr_numbers:
+            # Free its half so the next Dragon Rise plugged in replaces it
+            dr_in_use &= ~(1 << dr_numbers.pop(jsname))
+
+    def scan_joysticks(names=None):
+        """
+        Look for joysticks that were plugged in, only the device files in names
+        if given. Return False if a joystick could not be opened yet.
+        """
+        nonlocal dr_in_use
+        opened_all = True
+        if names is None:
+            # The directory entries include the inode numbers so no stat() is needed
+            with os.scandir('/dev/input') as entries:
+                found = [(entry.name, entry.inode()) for entry in entries]
+        else:
+            found = [(fn, None) for fn in names]
+        # For all joysticks in /dev/input/ that are not open, open it and add it to the
+        # event loop. Joysticks already open are skipped without a system call.
+        for fn, ino in found:
             if fn.startswith('js'):
                 jsname = '/dev/input/' + fn
                 if not jsname in joysticks:
+                    if ino is None:
+                        try:
+                            ino = os.stat(jsname).st_ino
+                        except OSError:
+                            continue
+                    probe = probed.get(jsname)
+                    if probe is not None and probe[0] != ino:
+                        probe = None
+                    if probe is not None and probe[1] is None:
+                        continue
                     try:
-                        jsdev = open(jsname, 'rb')
+                        jsdev = open(jsname, 'rb', buffering=0)
                     except:
-                        break
-                    buf = array.array('B', [0] * 64)
-                    ioctl(jsdev, 0x80006a13 + (0x10000 * len(buf)), buf) # JSIOCGNAME(len)
-                    jslongname = buf.tobytes().rstrip(b'\x00').decode('utf-8').upper()
-                    if 'HORIPAD' in jslongname:
-                        print("Found HoriPad")
-                        thr_id = threading.Thread(target=read_horipad, args=(jsdev,), daemon=True)
-                        thr_id.start()
-                        joysticks[jsname] = thr_id
-                    elif 'DRAGONRISE INC.' in jslongname:
-                        print("Found Dragon Rise")
+                        opened_all = False
+                        continue
+                    if probe is None:
+                        # The name ends at the first NUL, after it is whatever a longer
+                        # name left behind. A name that fills the buffer has no NUL.
+                        ioctl(jsdev, JSIOCGNAME_64, name_buf)
+                        jslongname = name_buf.partition(b'\x00')[0].upper()
+                        probe = probed[jsname] = (ino, joystick_type(jslongname))
+                        if probe[1] is None:
+                            jsdev.close()
+                            continue
+                    label, schema = probe[1]
+                    ioctl(jsdev, JSIOCGAXES, axes_buf)
+                    num_axes = axes_buf[0]
+                    print("Found " + label)
+                    if schema is None:
                         # At least 2 DR arcade joysticks are required to make a gamepad.
-                        if dr_count & 1:
-                            thr_id = threading.Thread(target=read_dragon_rise, args=(jsdev, True,), daemon=True)
-                            thr_id.start()
-                        else:
-                            thr_id = threading.Thread(target=read_dragon_rise, args=(jsdev, False,), daemon=True)
-                            thr_id.start()
-                        dr_count += 1
-                        joysticks[jsname] = thr_id
-                    elif 'LOGITECH EXTREME 3D' in jslongname:
-                        print("Found Logitech Extreme 3D Pro")
-                        thr_id = threading.Thread(target=read_le3dp, args=(jsdev,), daemon=True)
-                        thr_id.start()
-                        joysticks[jsname] = thr_id
-                    elif 'THRUSTMASTER T.16000M' in jslongname:
-                        print("Found Thrustmaster T.16000M")
-                        thr_id = threading.Thread(target=read_t16k, args=(jsdev,), daemon=True)
-                        thr_id.start()
-                        joysticks[jsname] = thr_id
-                    elif 'MICROSOFT X-BOX ONE' in jslongname:
-                        print("Found Xbox One")
-                        thr_id = threading.Thread(target=read_xbox1, args=(jsdev,), daemon=True)
-                        thr_id.start()
-                        joysticks[jsname] = thr_id
-                    elif 'SONY INTERACTIVE ENTERTAINMENT WIRELESS CONTROLLER' in jslongname:
-                        print("Found Sony PS4DS")
-                        thr_id = threading.Thread(target=read_ps4ds, args=(jsdev,), daemon=True)
-                        thr_id.start()
-                        joysticks[jsname] = thr_id
-                    elif 'GENERIC X-BOX PAD' in jslongname:
-                        print("Found Hori Mario Wheel")
-                        thr_id = threading.Thread(target=read_hori_wheel, args=(jsdev,), daemon=True)
-                        thr_id.start()
-                        joysticks[jsname] = thr_id
-                    else:
+                        # Use the lowest free number.
+                        dr_number = (~dr_in_use & (dr_in_use + 1)).bit_length() - 1
+                        dr_in_use |= 1 << dr_number
+                        dr_numbers[jsname] = dr_number
+                        schema = DRAGON_RISE_SCHEMAS[dr_number & 1]
+                    parser = read_joystick(schema, num_axes)
+                    start_reader(loop, jsname, jsdev, parser, joystick_removed)
+                    joysticks[jsname] = jsdev
+        return opened_all
+
+    def poll_joysticks(last_mtime=None):
+        """ Scan for joysticks once a second when inotify is not available """
+        # Adding or removing a device file changes the directory mtime so skip
+        # the scan until it changes. Scan again if a joystick could not be
+        # opened because udev may not have set its permissions yet.
+        mtime = os.stat('/dev/input').st_mtime_ns
+        if mtime != last_mtime and not scan_joysticks():
+            mtime = None
+        loop.call_later(1.0, poll_joysticks, mtime)
+
+    def input_changed():
+        """ Called by the event loop when a device in /dev/input changes """
+        changed = set()
+        for mask, name in inotify_events(inotify_fd, inotify_buf):
+            if name.startswith('js'):
+                changed.add(name)
+                jsname = '/dev/input/' + name
+                if mask & IN_DELETE:
+                    probed.pop(jsname, None)
+                    if jsname in joysticks:
+                        # Do not wait for the read to fail. A joystick replugged
+                        # quickly gets the same name and would be skipped by the
+                        # scan below while the old one is still in joysticks.
+                        jsdev = joysticks[jsname]
+                        loop.remove_reader(jsdev)
                         jsdev.close()
+                        joystick_removed(jsname)
+        if changed:
+            scan_joysticks(changed)
 
-        time.sleep(0.1)
+    # udev changes the owner and mode of new device files after they are
+    # created so also watch for attribute changes. The joystick may not be
+    # readable until then.
+    inotify_fd = inotify_watch('/dev/input', IN_CREATE | IN_ATTRIB | IN_DELETE)
+    inotify_buf = bytearray(4096)
+    if inotify_fd is None:
+        poll_joysticks()
+    else:
+        loop.add_reader(inotify_fd, input_changed)
+        # Pick up joysticks plugged in before the watch started
+        scan_joysticks()
+    # Stop as soon as systemd or Ctrl-C asks
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, loop.stop)
+    loop.run_forever()
+    loop.close()
+    # The loop can stop before LOOP_BATCH.release runs. Close that batch or
+    # the report below is never sent.
+    if LOOP_BATCH.holding:
+        LOOP_BATCH.release()
+    # Do not leave anything held down on the NS gadget
+    with NSG.batch():
+        NSG.releaseAll()
+        NSG.dPad(NSDPad.CENTERED)
+        for axis in (NSG.leftXAxis, NSG.leftYAxis, NSG.rightXAxis, NSG.rightYAxis):
+            axis(128)
+    NSG.end()
 
 if __name__ == "__main__":
     main()
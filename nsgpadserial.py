@@ -24,11 +24,16 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
-from struct import pack
+from struct import Struct
 import array
 import threading
+from contextlib import contextmanager
 from enum import IntEnum
 
+# Frame sent to NSGadget for each gamepad state: 2, 9, 2, buttons, direction
+# pad, left X, left Y, right X, right Y, 0, 3
+NSG_REPORT = Struct('<BBBHBBBBBBB')
+
 # Direction pad names
 class NSDPad(IntEnum):
     """NSDPad direction names"""
@@ -71,7 +76,8 @@ class NSGamepadSerial:
             128, 128, 128, 128, 128, 128, 128, 128, 128])
 
     def __init__(self):
-        self.thread_lock = threading.Lock()
+        self.thread_lock = threading.RLock()
+        self.batch_depth = 0
         self.ser_port = 0
         self.left_x_axis = 128
         self.left_y_axis = 128
@@ -81,6 +87,10 @@ class NSGamepadSerial:
         self.d_pad = 15
         self.dpad_x_axis = 128
         self.dpad_y_axis = 128
+        # Reports are packed into one buffer and compared with the other, the
+        # last one sent. The buffers swap after each write.
+        self.report = bytearray(NSG_REPORT.size)
+        self.last_report = bytearray(NSG_REPORT.size)
 
     def begin(self, serial_port):
         """Start NSGamepad"""
@@ -94,6 +104,8 @@ class NSGamepadSerial:
             self.d_pad = 15
             self.dpad_x_axis = 128
             self.dpad_y_axis = 128
+            # No report starts with 0 so the next write always sends
+            self.last_report[:] = bytes(NSG_REPORT.size)
             self.write()
         return
 
@@ -102,13 +114,31 @@ class NSGamepadSerial:
         self.ser_port.close()
         return
 
+    @contextmanager
+    def batch(self):
+        """Send NSGamepad state once for all changes made in the with block"""
+        with self.thread_lock:
+            self.batch_depth += 1
+            try:
+                yield self
+            finally:
+                self.batch_depth -= 1
+                self.write()
+
     def write(self):
-        """Send NSGamepad state"""
-        self.ser_port.write(pack('<BBBHBBBBBBB', 2, 9, 2, self.my_buttons, \
+        """Send NSGamepad state unless inside batch() or it has not changed"""
+        if self.batch_depth:
+            return
+        report = self.report
+        NSG_REPORT.pack_into(report, 0, 2, 9, 2, self.my_buttons, \
             self.d_pad, self.left_x_axis, self.left_y_axis, \
             self.right_x_axis, \
             self.right_y_axis, \
-            0, 3))
+            0, 3)
+        if report == self.last_report:
+            return
+        self.ser_port.write(report)
+        self.report, self.last_report = self.last_report, report
         return
 
     def press(self, button_number):